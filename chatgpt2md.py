@@ -84,12 +84,24 @@ from __future__ import annotations
 
 import argparse
 import json
+import math
+import mmap
 import os
 import re
 import sys
-from dataclasses import dataclass, field
+import time
+from collections import deque
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple
+from functools import lru_cache
+from types import ModuleType
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+# 可选加速：已安装 orjson 则用于解析 JSON，未安装时回退标准库 json
+_orjson: Optional[ModuleType]
+try:
+    import orjson as _orjson
+except ImportError:
+    _orjson = None
 
 
 # ==============================================================================
@@ -106,7 +118,13 @@ TRIPLE_BLANK = [BLANK, BLANK, BLANK]  # 三行空行占位
 # 2) 时间格式化 / HTML 最小转义 / 多行 block 输出
 # ==============================================================================
 
-def format_time(create_time: Optional[float]) -> str:
+# 只读的“空容器”哨兵：用于 `d.get(k) or _EMPTY_DICT` 这类兜底，
+# 避免每次调用都新建一个空 dict/list（`d.get(k, {})` 的默认值无论命中与否都会被创建）。
+# ⚠️ 只能读取，任何代码都不得修改它们。
+_EMPTY_DICT: Dict[str, Any] = {}
+_EMPTY_LIST: List[Any] = []
+
+def format_time(create_time: Any) -> str:
     """
     将 create_time（Unix 时间戳：秒/浮点秒）格式化为 YYYY-MM-DD HH:MM:SS。
     None 或异常 -> "未知时间"
@@ -114,28 +132,66 @@ def format_time(create_time: Optional[float]) -> str:
     if create_time is None:
         return "未知时间"
     try:
-        dt = datetime.fromtimestamp(float(create_time))
-        return dt.strftime("%Y-%m-%d %H:%M:%S")
+        # 与 datetime.fromtimestamp 一致：先舍入到微秒，再向下取整到秒（负数同样向下）
+        return _format_epoch_seconds(math.floor(round(float(create_time), 6)))
     except Exception:
         return "未知时间"
 
 
-def _html_escape(s: str) -> str:
+@lru_cache(maxsize=4096)
+def _format_epoch_seconds(seconds: int) -> str:
+    """
+    按整秒格式化本地时间（带缓存）。
+    直接拼 struct_time 字段，省掉 datetime 对象与 strftime 的开销。
+    """
+    lt = time.localtime(seconds)
+    if not 1000 <= lt.tm_year < 9999:
+        # 四位数以外的年份（strftime 的 %Y 不补零）或接近 datetime 支持范围（1~9999 年）的边界：
+        # 交给 datetime，结果与超出范围时的报错都和原实现一致
+        return datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+    return "%04d-%02d-%02d %02d:%02d:%02d" % (
+        lt.tm_year, lt.tm_mon, lt.tm_mday, lt.tm_hour, lt.tm_min, lt.tm_sec,
+    )
+
+
+_HTML_ESCAPE_TABLE = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;"})
+_HTML_SPECIAL_RE = re.compile(r'[&<>"]')
+
+
+def _html_escape(s: Optional[str]) -> str:
     """
     最小 HTML 转义：避免模型名、时间等字符串里出现 < > & " 影响 HTML 结构。
+    None 或空串直接返回 ""；先用正则找特殊字符，没有就原样返回（最常见的情况，只扫一遍）；
+    有才用 str.translate 统一替换（共两遍，仍少于链式 replace 的四遍）。
     """
-    return (s or "").replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+    if not s:
+        return ""
+    # 绝大多数字段（模型名、时间、文件名……）不含特殊字符：原样返回，不分配新字符串
+    if _HTML_SPECIAL_RE.search(s) is None:
+        return s
+    return s.translate(_HTML_ESCAPE_TABLE)
+
+
+# splitlines() 认作换行、但 "\n".join / str.replace("\n", ...) 不会处理的字符
+_OTHER_LINE_BREAK_RE = re.compile('[\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
 
 
 def _extend_block(lines: List[str], block: str) -> None:
     """
-    把一个“多行字符串”按行拆开追加到 lines。
+    把一个“多行字符串”按行追加到 lines（lines 最终以 "\n".join 输出）。
     注意：这里不额外插空行，完全由调用者控制排版。
+
+    常见情况（非空、只含 \n、不以换行结尾）整块追加即可，
+    最终 join 的结果与逐行拆开完全相同，省掉一次拆行；
+    其余情况仍按 splitlines() 拆开，保证输出只用 \n 分行。
     """
     if block is None:
         return
-    for ln in str(block).splitlines():
-        lines.append(ln)
+    block = str(block)
+    if block and not block.endswith("\n") and _OTHER_LINE_BREAK_RE.search(block) is None:
+        lines.append(block)
+    else:
+        lines.extend(block.splitlines())
 
 
 # ==============================================================================
@@ -148,45 +204,85 @@ def _extend_block(lines: List[str], block: str) -> None:
 # ==============================================================================
 _LIST_LINE_RE = re.compile(r'^\s*(?:[-*]|\d+\.)\s+')
 _FENCE_RE = re.compile(r'^\s*(?:>+\s*)?```')
+_DISPLAY_INLINE_RE = re.compile(r'\\\[(.+?)\\\]', re.DOTALL)  # 同一行内 \[...\]
+_INLINE_MATH_RE = re.compile(r'\\\((.+?)\\\)')               # 行内 \(...\)
 
 
-def _in_list_context(prev_lines: List[str]) -> bool:
+def _update_list_context(in_list: bool, line: str) -> bool:
+    """
+    随输出逐行维护“是否处在列表项上下文”：
+    - 空行：结束上下文
+    - 列表起始行（-/*/1.等）：进入上下文
+    - 其他行：保持不变
+    等价于“从输出末尾向上回溯至空行，途中是否遇到列表起始行”，但每行只需 O(1)。
+    用于决定 $$ 公式块是否整体缩进两格。
     """
-    向上回溯至空行：
-    - 只要遇到列表起始行（-/*/1.等）则判定当前处在列表项上下文
-    - 用于决定 $$ 公式块是否整体缩进两格
+    if line.strip() == '':
+        return False
+    if _LIST_LINE_RE.match(line):
+        return True
+    return in_list
+
+
+def _needs_beautify(s: str) -> bool:
+    r"""
+    是否含有需要美化的 LaTeX 定界符（\( 或 \[）。
+    不含时 beautify_markdown 的结果与输入完全相同（代码围栏本身不触发任何替换）。
     """
-    for j in range(len(prev_lines) - 1, -1, -1):
-        if prev_lines[j].strip() == '':
-            break
-        if _LIST_LINE_RE.match(prev_lines[j]):
-            return True
-    return False
+    return '\\(' in s or '\\[' in s
 
 
 def beautify_markdown(md_text: str) -> str:
     """
     对“非代码块”的文本做最小必要的 LaTeX/Markdown 美化。
     """
+    # 大多数消息不含公式：直接原样返回，省掉整篇拆行/拼接
+    if not _needs_beautify(md_text):
+        return md_text
+    return _beautify_math_text(md_text)
+
+
+@lru_cache(maxsize=16)
+def _beautify_math_text(md_text: str) -> str:
+    """
+    beautify_markdown 的实际处理（纯函数，带缓存）：
+    相邻消息里重复出现的含公式文本（反复引用的上下文、复述等）直接复用上次结果。
+    只缓存含公式的文本；缓存很小，且每次转换结束时清空，
+    不会让整段对话的消息正文一直驻留在内存里。
+    """
     lines = md_text.split('\n')
     out: List[str] = []
+    out_append = out.append  # 热循环内避免反复查找属性
+    n = len(lines)
     in_code = False
+    in_list = False  # 已输出内容的末尾是否处在列表项上下文
     i = 0
 
-    while i < len(lines):
+    while i < n:
         line = lines[i]
+
+        # 快速路径：既无 '\' 也无 '`' 的行不可能是围栏或公式，原样输出
+        # （绝大多数正文行走这里，省掉后续的正则匹配）
+        if '\\' not in line and '`' not in line:
+            out_append(line)
+            in_list = _update_list_context(in_list, line)
+            i += 1
+            continue
+
         stripped = line.strip()
 
         # 进入/退出代码围栏（支持引用内围栏）
         if _FENCE_RE.match(line):
             in_code = not in_code
-            out.append(line)
+            out_append(line)
+            in_list = _update_list_context(in_list, line)
             i += 1
             continue
 
         # 代码块内：不做任何替换
         if in_code:
-            out.append(line)
+            out_append(line)
+            in_list = _update_list_context(in_list, line)
             i += 1
             continue
 
@@ -194,56 +290,62 @@ def beautify_markdown(md_text: str) -> str:
         if stripped == r'\[':
             i += 1
             formula_lines: List[str] = []
-            while i < len(lines) and lines[i].strip() != r'\]':
+            while i < n and lines[i].strip() != r'\]':
                 formula_lines.append(lines[i].strip())
                 i += 1
-            if i < len(lines) and lines[i].strip() == r'\]':
+            if i < n and lines[i].strip() == r'\]':
                 i += 1
 
-            indent = '  ' if _in_list_context(out) else ''
+            indent = '  ' if in_list else ''
 
             # 公式块前补空行（真实空行，这里不使用 BLANK，因为这是正文内部排版）
             if out and out[-1].strip() != '':
-                out.append('')
+                out_append('')
 
-            out.append(f'{indent}$$')
+            out_append(f'{indent}$$')
             for fl in formula_lines:
-                out.append(f'{indent}{fl}')
-            out.append(f'{indent}$$')
+                out_append(f'{indent}{fl}')
+            out_append(f'{indent}$$')
 
-            # 公式块后补空行
-            out.append('')
+            # 公式块后补空行（空行即结束列表上下文）
+            out_append('')
+            in_list = False
             continue
 
         # 同一行内 '\[...\]' -> $$...$$（少见，仍支持）
-        m = re.search(r'\\\[(.+?)\\\]', line, flags=re.DOTALL)
+        m = _DISPLAY_INLINE_RE.search(line)
         if m:
             before = line[:m.start()].rstrip()
             mid = m.group(1).strip()
             after = line[m.end():].lstrip()
-            indent = '  ' if _in_list_context(out) else ''
+            indent = '  ' if in_list else ''
 
             if before:
-                out.append(before)
+                out_append(before)
             if out and out[-1].strip() != '':
-                out.append('')
+                out_append('')
+            in_list = False
 
-            out.append(f'{indent}$$')
+            out_append(f'{indent}$$')
             for sub in mid.splitlines():
-                out.append(f'{indent}{sub.strip()}')
-            out.append(f'{indent}$$')
+                sub_line = f'{indent}{sub.strip()}'
+                out_append(sub_line)
+                in_list = _update_list_context(in_list, sub_line)
+            out_append(f'{indent}$$')
 
             if after:
-                out.append('')
-                out.append(after)
+                out_append('')
+                out_append(after)
+                in_list = _update_list_context(False, after)
 
             i += 1
             continue
 
         # 行内公式：\( ... \) -> $...$
-        line = re.sub(r'\\\((.+?)\\\)', r'$\1$', line)
+        line = _INLINE_MATH_RE.sub(r'$\1$', line)
 
-        out.append(line)
+        out_append(line)
+        in_list = _update_list_context(in_list, line)
         i += 1
 
     return '\n'.join(out)
@@ -255,6 +357,11 @@ def beautify_markdown(md_text: str) -> str:
 # 解析 multimodal_text.parts 中的 image_asset_pointer，并按顺序插入占位符。
 # 你后续可以写个“二次处理脚本”，扫描 <!--CHATGPT_IMG ...--> 注释并替换为真实 URL 图片标签。
 # ==============================================================================
+_SEDIMENT_PREFIX = "sediment://"
+_SEDIMENT_PREFIX_LEN = len(_SEDIMENT_PREFIX)
+_FILE_ID_RE = re.compile(r'(file_[A-Za-z0-9]+)')
+
+
 def _extract_file_id(asset_pointer: str) -> Optional[str]:
     """
     从 asset_pointer 中抽取 file id。
@@ -263,12 +370,27 @@ def _extract_file_id(asset_pointer: str) -> Optional[str]:
     """
     if not asset_pointer or not isinstance(asset_pointer, str):
         return None
-    if asset_pointer.startswith("sediment://"):
-        return asset_pointer[len("sediment://"):]
-    m = re.search(r'(file_[A-Za-z0-9]+)', asset_pointer)
+    if asset_pointer.startswith(_SEDIMENT_PREFIX):
+        return asset_pointer[_SEDIMENT_PREFIX_LEN:]
+    m = _FILE_ID_RE.search(asset_pointer)
     return m.group(1) if m else None
 
 
+def _as_int(x: Any) -> Optional[int]:
+    """
+    x 恰为 int 时原样返回，否则返回 None。
+    用 type(x) is int 而非 isinstance：更快，且把 JSON 里的 true/false 排除在尺寸之外。
+    """
+    return x if type(x) is int else None
+
+
+# 占位符模板：可读提示行 + HTML 注释（一次 % 格式化生成整段）
+_IMAGE_PLACEHOLDER_TMPL = (
+    '🖼️ Image %s: %s\n'
+    '<!--CHATGPT_IMG kind="%s" id="%s" name="%s" w="%s" h="%s" src="%s"-->'
+)
+
+
 def _render_image_placeholder(
     index: int,
     *,
@@ -284,21 +406,23 @@ def _render_image_placeholder(
       1) 可读提示（告诉读者这里原来有一张图）
       2) HTML 注释（携带足够元信息，便于后处理替换 URL）
     """
-    label = f"Image {index}"
+    esc = _html_escape
     shown = name or file_id or "unknown"
-    w = str(width) if isinstance(width, int) else ""
-    h = str(height) if isinstance(height, int) else ""
-
-    comment = (
-        f'<!--CHATGPT_IMG kind="{_html_escape(kind)}" '
-        f'id="{_html_escape(file_id or "")}" '
-        f'name="{_html_escape(name or "")}" '
-        f'w="{_html_escape(w)}" h="{_html_escape(h)}" '
-        f'src="{_html_escape(src or "")}"-->'
+    # 宽高只可能是整数的十进制文本，无需转义（空字段由 _html_escape 直接返回 ""）
+    w = "" if _as_int(width) is None else str(width)
+    h = "" if _as_int(height) is None else str(height)
+
+    return _IMAGE_PLACEHOLDER_TMPL % (
+        index,
+        shown,
+        esc(kind),
+        esc(file_id),
+        esc(name),
+        w,
+        h,
+        esc(src),
     )
 
-    return f"🖼️ {label}: {shown}\n{comment}"
-
 
 def _render_message_parts_with_images(msg: Dict[str, Any]) -> List[str]:
     """
@@ -306,18 +430,12 @@ def _render_message_parts_with_images(msg: Dict[str, Any]) -> List[str]:
       - 字符串：原样保留（非空）
       - image_asset_pointer：转为占位符（两行）
     """
-    content = msg.get("content", {}) or {}
-    parts = content.get("parts", []) or []
-
-    # attachments 里通常有 name/width/height 等辅助信息
-    metadata = msg.get("metadata", {}) or {}
-    attachments = metadata.get("attachments", []) or []
+    content = msg.get("content") or _EMPTY_DICT
+    parts = content.get("parts") or _EMPTY_LIST
 
-    # id -> attachment dict
-    att_map: Dict[str, Dict[str, Any]] = {}
-    for a in attachments:
-        if isinstance(a, dict) and a.get("id"):
-            att_map[str(a["id"])] = a
+    # id -> attachment dict（attachments 里通常有 name/width/height 等辅助信息）
+    # 遇到第一张图片时才构建：纯文本消息（绝大多数）完全不碰 attachments
+    att_map: Optional[Dict[str, Dict[str, Any]]] = None
 
     rendered: List[str] = []
     img_idx = 0
@@ -334,18 +452,27 @@ def _render_message_parts_with_images(msg: Dict[str, Any]) -> List[str]:
             img_idx += 1
             src = p.get("asset_pointer") or ""
             fid = _extract_file_id(src) or (src if src else "")
-            att = att_map.get(str(fid), {})
+            if att_map is None:
+                metadata = msg.get("metadata") or _EMPTY_DICT
+                attachments = metadata.get("attachments") or _EMPTY_LIST
+                att_map = {str(a["id"]): a for a in attachments if isinstance(a, dict) and a.get("id")}
+            att = att_map.get(str(fid)) or _EMPTY_DICT
 
             name = att.get("name") or ""
-            w = p.get("width") if isinstance(p.get("width"), int) else att.get("width")
-            h = p.get("height") if isinstance(p.get("height"), int) else att.get("height")
+            # 宽高以 part 自带的为准，缺失/非整数时再退回 attachment 的
+            w = _as_int(p.get("width"))
+            if w is None:
+                w = _as_int(att.get("width"))
+            h = _as_int(p.get("height"))
+            if h is None:
+                h = _as_int(att.get("height"))
 
             rendered.append(_render_image_placeholder(
                 img_idx,
                 file_id=str(fid) if fid else None,
                 name=str(name) if name else None,
-                width=w if isinstance(w, int) else None,
-                height=h if isinstance(h, int) else None,
+                width=w,
+                height=h,
                 src=str(src) if src else None,
                 kind="attachment",
             ))
@@ -361,16 +488,41 @@ def _render_message_parts_with_images(msg: Dict[str, Any]) -> List[str]:
 # ------------------------------------------------------------------------------
 # ✅ 关键修复：blockquote 的“空行也要加 > ”，否则引用会断。
 # ==============================================================================
-def _to_blockquote(s: str) -> str:
+def _quoted_lines(s: str) -> Iterator[str]:
+    """
+    逐行产出带 '> ' 前缀的引用行（空行同样加前缀，原因见 _to_blockquote）。
     """
+    return ("> " + ln for ln in s.splitlines())
+
+
+def _to_blockquote(s: str) -> str:
+    r"""
     把多行字符串逐行变成 blockquote。
 
     为什么空行也要加 '> '？
     - Markdown 里 blockquote 遇到真正的空行，往往会结束引用块；
     - 如果推理段中含代码围栏，围栏中间有空行，就可能导致围栏被拆断；
     - 结果就是：代码块/引用块排版彻底乱掉。
+
+    例：
+        >>> _to_blockquote("a\n\nb")
+        '> a\n> \n> b'
+        >>> _to_blockquote("a\n\nb") == "\n".join("> " + ln for ln in "a\n\nb".splitlines())
+        True
     """
-    return "\n".join(["> " + ln for ln in s.splitlines()])
+    if not s:
+        return ""
+    # 常见情况：只含 \n 换行 -> 一次 C 层 replace 完成，不逐行拆分再拼接
+    if _OTHER_LINE_BREAK_RE.search(s) is None:
+        if s.endswith("\n"):
+            s = s[:-1]  # 与 splitlines() 一致：末尾换行不产生额外的空引用行
+        return "> " + s.replace("\n", "\n> ")
+    # 含 \r、\f、U+2028 等其他换行符：按 splitlines() 的语义逐行处理
+    return "\n".join(_quoted_lines(s))
+
+
+# 这些 language 值视为“无语言”，代码围栏不标注语言
+_PLAIN_LANGS = frozenset({"", "unknown", "plain", "text"})
 
 
 def _render_code_run(title: str, lang: str, code: str, output: str) -> str:
@@ -383,58 +535,89 @@ def _render_code_run(title: str, lang: str, code: str, output: str) -> str:
       ```
       output
       ```
-    最后整段转为 blockquote（每行前缀 > ）
+    整段先用一个模板拼好，再一次性转为 blockquote（每行前缀 > ）
     """
-    blocks: List[str] = []
-
     title = (title or "").strip()
-    if title:
-        blocks.append(f"**{title}**")
+    title_line = f"**{title}**\n" if title else ""
 
     lang = (lang or "").strip().lower()
-    fence_open = f"```{lang}" if lang not in ("", "unknown", "plain", "text") else "```"
+    fence_open = "```" if lang in _PLAIN_LANGS else f"```{lang}"
 
-    blocks.append(fence_open)
-    blocks.append((code or "").rstrip("\n"))
-    blocks.append("```")
+    code = (code or "").rstrip("\n")
 
+    output_block = ""
     if output and output.strip():
-        blocks.append("```")
-        blocks.append(output.strip("\n"))
-        blocks.append("```")
+        output = output.strip("\n")
+        output_block = f"\n```\n{output}\n```"
 
-    return _to_blockquote("\n".join(blocks))
+    return _to_blockquote(f"{title_line}{fence_open}\n{code}\n```{output_block}")
 
 
 # ==============================================================================
 # 6) ReasoningSession：收集 thoughts/code/tool-output/recap，并生成 <details>
 # ==============================================================================
-@dataclass(order=True)
 class _SessionItem:
     """
     会话内条目（用于排序输出）
     - type: 'thought' | 'code'
     - time: 用于排序（None 视为 0.0）
     - seq: 同一时间戳下保持稳定顺序
+
+    使用 __slots__：条目数量多时不为每个实例分配 __dict__。
     """
-    sort_index: tuple = field(init=False, repr=False)
-    type: str = field(compare=False)
-    time: Optional[float] = field(compare=False, default=None)
-    seq: int = field(compare=False, default=0)
+    __slots__ = (
+        "type", "time", "seq",
+        "summary", "content",                               # thought
+        "title", "lang", "code", "output", "_code_time",    # code
+    )
 
-    # thought
-    summary: str = field(compare=False, default="")
-    content: str = field(compare=False, default="")
+    def __init__(
+        self,
+        type: str,
+        time: Any = None,
+        seq: int = 0,
+        summary: str = "",
+        content: str = "",
+        title: str = "",
+        lang: str = "",
+        code: str = "",
+        output: Optional[str] = None,
+        _code_time: Any = None,
+    ) -> None:
+        self.type = type
+        self.time = time
+        self.seq = seq
+        self.summary = summary
+        self.content = content
+        self.title = title
+        self.lang = lang
+        self.code = code
+        self.output = output
+        self._code_time = _code_time
+
+
+def _item_sort_key(it: _SessionItem) -> Tuple[Any, int]:
+    """排序键：(time, seq)，time 为 None 视为 0.0。按需计算，不在条目上另存。"""
+    return ((it.time or 0.0), it.seq)
+
+
+def _key_lt(a: Tuple[Any, int], b: Tuple[Any, int]) -> bool:
+    """
+    排序键 a < b？
+    time 来自 JSON，可能是无法与数字比较的值（如非数字字符串）：此时保守地返回 True，
+    让 build_details_block 走完整排序，是否可排序由那里决定（与逐条比较前的行为一致）。
+    """
+    try:
+        return a < b
+    except TypeError:
+        return True
 
-    # code
-    title: str = field(compare=False, default="")
-    lang: str = field(compare=False, default="")
-    code: str = field(compare=False, default="")
-    output: Optional[str] = field(compare=False, default=None)
-    _code_time: Optional[float] = field(compare=False, default=None)
 
-    def __post_init__(self):
-        self.sort_index = ((self.time or 0.0), self.seq)
+# <details> 开头两行模板（参数为已转义的 summary 文本）
+_DETAILS_HEAD_TMPL = (
+    "<details>\n"
+    '<summary style="font-weight: bold; color: #10ac84; cursor: pointer;">🤔 %s</summary>'
+)
 
 
 class ReasoningSession:
@@ -445,8 +628,18 @@ class ReasoningSession:
         self.items: List[_SessionItem] = []
         self.recap_text: Optional[str] = None
         self._seq = 0
-
-    def add_thoughts(self, msg_time: Optional[float], thought_list: Any) -> None:
+        # 尚未拿到输出的 code 项（按加入顺序；栈顶即“最近一条未配对 code”）
+        self._unpaired_codes: List[_SessionItem] = []
+        # items 是否已偏离排序键升序（多数会话按时间顺序到达，无需再排序）
+        self._needs_sort = False
+
+    def _append_item(self, item: _SessionItem) -> None:
+        """追加条目，并在其排序键小于前一条时标记需要排序。"""
+        if self.items and _key_lt(_item_sort_key(item), _item_sort_key(self.items[-1])):
+            self._needs_sort = True
+        self.items.append(item)
+
+    def add_thoughts(self, msg_time: Any, thought_list: Any) -> None:
         """
         收集 content_type == "thoughts" 的每段 thought（summary + content）。
         注意：导出 JSON 中 thoughts 往往是一个数组，每段都有自己的 summary/content。
@@ -460,7 +653,7 @@ class ReasoningSession:
             cont = (t.get("content") or "").strip()
             if not summ and not cont:
                 continue
-            self.items.append(_SessionItem(
+            self._append_item(_SessionItem(
                 type="thought",
                 time=msg_time,
                 seq=self._seq,
@@ -469,12 +662,12 @@ class ReasoningSession:
             ))
             self._seq += 1
 
-    def add_code(self, msg_time: Optional[float], title: str, lang: str, code_text: str) -> None:
+    def add_code(self, msg_time: Any, title: str, lang: str, code_text: str) -> None:
         """
         收集 assistant 的 content_type == "code"。
         tool 输出会在后续用 pair_code_output() 绑定到最近一条未绑定的 code。
         """
-        self.items.append(_SessionItem(
+        item = _SessionItem(
             type="code",
             time=msg_time,
             seq=self._seq,
@@ -483,20 +676,31 @@ class ReasoningSession:
             code=code_text or "",
             output=None,
             _code_time=msg_time,
-        ))
+        )
+        self._append_item(item)
+        self._unpaired_codes.append(item)
         self._seq += 1
 
-    def pair_code_output(self, output_time: Optional[float], output_text: str) -> None:
+    def pair_code_output(self, output_time: Any, output_text: str) -> None:
         """
         将 tool(name="python") 的 execution_output 绑定到最近一条尚无输出的 code 项。
         绑定后，使用输出时间作为 code 项的排序时间（更贴近“代码+结果完成”的时序）。
         """
-        for item in reversed(self.items):
-            if item.type == "code" and item.output in (None, ""):
-                item.output = output_text or ""
-                item.time = output_time if output_time is not None else item._code_time
-                item.sort_index = ((item.time or 0.0), item.seq)
-                return
+        if not self._unpaired_codes:
+            return
+        item = self._unpaired_codes.pop()
+        item.output = output_text or ""
+        old_key = _item_sort_key(item)
+        item.time = output_time if output_time is not None else item._code_time
+        new_key = _item_sort_key(item)
+        if new_key != old_key:
+            # 只有“末尾条目且仍不小于前一条”时顺序才不被破坏
+            items = self.items
+            if item is not items[-1] or (len(items) > 1 and _key_lt(new_key, _item_sort_key(items[-2]))):
+                self._needs_sort = True
+        # 空输出视为“仍未配对”，下一条输出依旧可以绑定到它
+        if not item.output:
+            self._unpaired_codes.append(item)
 
     def set_recap(self, recap_text: str) -> None:
         """设置 <summary> 的文本（例如“已思考 1m 7s”）。"""
@@ -515,40 +719,34 @@ class ReasoningSession:
         if not self.items and not self.recap_text:
             return None
 
-        items_sorted = sorted(self.items)
+        items_sorted = sorted(self.items, key=_item_sort_key) if self._needs_sort else self.items
         parts: List[str] = []
 
         for it in items_sorted:
             if it.type == "thought":
-                block_lines: List[str] = []
-
-                if it.summary:
-                    block_lines.append("> **" + it.summary + "**")
+                # 摘要行与正文引用直接拼成一个字符串，不再经中间行列表
+                summary_line = f"> **{it.summary}**" if it.summary else ""
+                body = _to_blockquote(beautify_markdown(it.content)) if it.content else ""
 
-                if it.content:
-                    pretty = beautify_markdown(it.content)
-                    block_lines.append(_to_blockquote(pretty))
-
-                if block_lines:
-                    parts.append("\n".join(block_lines).rstrip())
+                if summary_line and body:
+                    parts.append(f"{summary_line}\n{body}".rstrip())
+                elif summary_line or it.content:
+                    parts.append((summary_line or body).rstrip())
 
             elif it.type == "code":
                 title = it.title or "代码推理"
                 parts.append(_render_code_run(title, it.lang or "", it.code or "", it.output or ""))
 
-        inner = "\n\n".join(parts)
-
         summary_text = self.recap_text if self.recap_text else default_summary
-        summary_text = f"🤔 {summary_text}"
 
-        block = (
-            "<details>\n"
-            f'<summary style="font-weight: bold; color: #10ac84; cursor: pointer;">{_html_escape(summary_text)}</summary>\n\n'
-            f"{inner}\n\n"
-            "</details>"
-        )
+        # 头部、各子项、尾部一次性 "\n\n".join，避免先拼出 inner 再整体复制一遍
+        # （无子项时保留一个空串占位，与原先“空 inner”的排版一致）
+        head = _DETAILS_HEAD_TMPL % _html_escape(summary_text)
+        block = "\n\n".join([head, *(parts or [""]), "</details>"])
 
         self.items.clear()
+        self._unpaired_codes.clear()
+        self._needs_sort = False
         self.recap_text = None
         self._seq = 0
         return block
@@ -565,35 +763,41 @@ def _render_ai_header() -> str:
     return '<h1 style="color: #10ac84;">🤖 AI Response</h1>'
 
 
+# 头部行模板：整段 HTML 作为一个常量，调用时只做一次 % 替换（参数均已转义）
+_USER_TIME_ROW_TMPL = (
+    '<div style="display: flex; gap: 10px; align-items: center; margin-bottom: 10px;">\n'
+    '    <div style="color: #888; font-size: 12px; font-family: sans-serif;">\n'
+    '        🕒 %s\n'
+    '    </div>\n'
+    '</div>'
+)
+
+_AI_META_ROW_TMPL = (
+    '<div style="display: flex; gap: 10px; align-items: center; margin-bottom: 10px;">\n'
+    '    <div style="background-color: #e3f2fd; color: #1565c0; padding: 2px 8px; border-radius: 12px; font-size: 12px; font-family: sans-serif; font-weight: bold; border: 1px solid #bbdefb;">\n'
+    '        %s\n'
+    '    </div>\n'
+    '    <div style="color: #888; font-size: 12px; font-family: sans-serif;">\n'
+    '        🕒 %s\n'
+    '    </div>\n'
+    '</div>'
+)
+
+
 def _render_user_time_row(time_str: str) -> str:
     """
     User 的时间行
     """
-    time_str = _html_escape(time_str or "未知时间")
-    return (
-        '<div style="display: flex; gap: 10px; align-items: center; margin-bottom: 10px;">\n'
-        '    <div style="color: #888; font-size: 12px; font-family: sans-serif;">\n'
-        f'        🕒 {time_str}\n'
-        '    </div>\n'
-        '</div>'
-    )
+    return _USER_TIME_ROW_TMPL % _html_escape(time_str or "未知时间")
 
 
 def _render_ai_meta_row(model_slug: str, time_str: str) -> str:
     """
     AI 的模型徽章 + 时间行（你给的示例）
     """
-    model_slug = _html_escape(model_slug or "unknown-model")
-    time_str = _html_escape(time_str or "未知时间")
-    return (
-        '<div style="display: flex; gap: 10px; align-items: center; margin-bottom: 10px;">\n'
-        '    <div style="background-color: #e3f2fd; color: #1565c0; padding: 2px 8px; border-radius: 12px; font-size: 12px; font-family: sans-serif; font-weight: bold; border: 1px solid #bbdefb;">\n'
-        f'        {model_slug}\n'
-        '    </div>\n'
-        '    <div style="color: #888; font-size: 12px; font-family: sans-serif;">\n'
-        f'        🕒 {time_str}\n'
-        '    </div>\n'
-        '</div>'
+    return _AI_META_ROW_TMPL % (
+        _html_escape(model_slug or "unknown-model"),
+        _html_escape(time_str or "未知时间"),
     )
 
 
@@ -604,7 +808,7 @@ def _get_model_slug_for_message(msg: Dict[str, Any], conversation_default: str)
     - message.metadata.default_model_slug
     - conversation_default_model
     """
-    meta = msg.get("metadata", {}) or {}
+    meta = msg.get("metadata") or _EMPTY_DICT
     slug = meta.get("model_slug") or meta.get("default_model_slug") or conversation_default or "unknown-model"
     return str(slug)
 
@@ -612,85 +816,165 @@ def _get_model_slug_for_message(msg: Dict[str, Any], conversation_default: str)
 # ==============================================================================
 # 8) 主流程：解析 JSON -> Markdown（严格换行，严格空行占位）
 # ==============================================================================
-ALLOWED_CONTENT_TYPES = {"text", "multimodal_text"}
+ALLOWED_CONTENT_TYPES = frozenset({"text", "multimodal_text"})
+_OUTPUT_ROLES = frozenset({"user", "assistant"})
 
+# 换行归一化：\r\n / \n\r / 单独的 \r 一次扫描统一为 \n
+_NEWLINE_RE = re.compile(r'\r\n?|\n\r')
 
-def parse_chat_to_markdown(json_file_path: str) -> str:
+
+# orjson 会把超出范围的整数（大于 2**64-1 或小于 -2**63）静默转成 float：
+# 18 位以内的整数总在范围内，出现 19 位及以上的连续数字时直接交给标准库
+# （字符串里的长数字串也会命中，只是多走一次标准库解析，结果不变）
+_LONG_DIGITS_RE = re.compile(rb'[0-9]{19}')
+
+
+def _loads_bytes(data: Any) -> Any:
+    """
+    解析 JSON 字节（bytes / memoryview）：优先 orjson，否则标准库 json。
+    orjson 比标准库严格（NaN/Infinity、孤立代理项 \\ud83d 等会被拒绝），
+    解析失败时改用标准库重试，保证能转换的文件与未安装 orjson 时完全一致；
+    两者都失败时抛出标准库的 json.JSONDecodeError。
+    """
+    if _orjson is not None and _LONG_DIGITS_RE.search(data) is None:
+        try:
+            return _orjson.loads(data)
+        except _orjson.JSONDecodeError:
+            pass
+    return json.loads(bytes(data))
+
+
+def _load_json(json_file_path: str) -> Any:
     """
-    核心转换函数：读取 JSON -> 只保留最终态分支 -> 输出 Markdown（带 HTML 样式）
+    读取并解析导出 JSON。
+    - 已安装 orjson：mmap 映射文件后直接解析字节（免一次用户态拷贝与解码）
+    - 否则：标准库 json 解析原始字节（编码由 json 自动识别）
+    """
+    with open(json_file_path, "rb") as f:
+        if _orjson is None:
+            return json.loads(f.read())
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):  # 空文件或不支持 mmap 的文件
+            return _loads_bytes(f.read())
+        with mm, memoryview(mm) as view:
+            return _loads_bytes(view)
+
+
+# ------------------------------------------------------------------------------
+# 推理素材收集：按 content_type /（role, content_type）查表分派，
+# 命中即交给 ReasoningSession，主循环不再逐个比较字符串。
+# ------------------------------------------------------------------------------
+def _handle_thoughts(session: ReasoningSession, msg: Dict[str, Any], content: Dict[str, Any],
+                     create_time: Any) -> None:
+    """A. 收集 thoughts"""
+    session.add_thoughts(create_time, content.get("thoughts", _EMPTY_LIST))
+
+
+def _handle_recap(session: ReasoningSession, msg: Dict[str, Any], content: Dict[str, Any],
+                  create_time: Any) -> None:
+    """B. 收集 reasoning_recap（用于 <details><summary>）"""
+    session.set_recap(content.get("content", ""))
+
+
+def _handle_code(session: ReasoningSession, msg: Dict[str, Any], content: Dict[str, Any],
+                 create_time: Any) -> None:
+    """C. 收集 assistant code（推理代码）"""
+    code_text = content.get("text", "") or ""
+    lang = (content.get("language") or "").strip().lower()
+
+    # 导出 JSON 里 language 经常是 unknown，但 recipient == "python" 能提示真实语言
+    recip = (msg.get("recipient") or "").strip().lower()
+    if lang in _PLAIN_LANGS and recip == "python":
+        lang = "python"
+
+    title = (msg.get("metadata") or _EMPTY_DICT).get("reasoning_title", "") or ""
+    session.add_code(create_time, title, lang, code_text)
+
+
+def _handle_tool_output(session: ReasoningSession, msg: Dict[str, Any], content: Dict[str, Any],
+                        create_time: Any) -> None:
+    """D. 收集 tool(name="python") 的 execution_output，并绑定到最近 code"""
+    author = msg.get("author") or _EMPTY_DICT
+    tool_name = (author.get("name") or "").lower()
+    if tool_name == "python":
+        session.pair_code_output(create_time, content.get("text", "") or "")
+
+
+_Handler = Callable[[ReasoningSession, Dict[str, Any], Dict[str, Any], Any], None]
+
+# (role, content_type) -> handler；role 为 None 表示“任意角色”（优先匹配）
+_HANDLERS: Dict[Tuple[Optional[str], Optional[str]], _Handler] = {
+    (None, "thoughts"): _handle_thoughts,
+    (None, "reasoning_recap"): _handle_recap,
+    ("assistant", "code"): _handle_code,
+    ("tool", "execution_output"): _handle_tool_output,
+}
+
+
+def iter_chat_markdown(json_file_path: str) -> Iterator[str]:
+    """
+    核心转换函数：读取 JSON -> 只保留最终态分支 -> 逐条消息产出 Markdown（带 HTML 样式）
+
+    - 每次 yield 一条消息（或兜底推理块）的完整 Markdown，末尾不带换行；
+      块与块之间以单个 "\n" 连接即得到完整文档（见 parse_chat_to_markdown）。
+    - JSON 的读取与解析发生在首次迭代时。
 
     严格排版策略（按行控制）：
     - 不使用 "\n\n".join(...) 自动插空行
     - 全部“段落间空行”使用 BLANK 或 TRIPLE_BLANK 精确控制
     """
-    with open(json_file_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = _load_json(json_file_path)
 
     # 会话级默认模型（兜底）
     conversation_default_model = str(data.get("default_model_slug") or "unknown-model")
 
-    mapping: Dict[str, Any] = data.get("mapping", {}) or {}
+    mapping: Dict[str, Any] = data.get("mapping") or _EMPTY_DICT
     current_id: Optional[str] = data.get("current_node")
 
     # 1) 回溯 parent 链构造最终分支（根 -> current_node）
-    branch_ids: List[str] = []
-    while current_id:
-        node = mapping.get(current_id)
-        if not node:
-            break
-        branch_ids.append(current_id)
-        parent = node.get("parent")
-        if not parent or parent not in mapping:
-            break
-        current_id = parent
-    branch_ids.reverse()
-
-    # 2) 遍历分支并输出
+    #    直接收集节点本身：每个节点只查一次 mapping，后续遍历也无需再查
+    #    从叶向根回溯时逐个插到队首，得到的就是根 -> 叶顺序，无需再 reverse
+    branch_nodes: Deque[Dict[str, Any]] = deque()
+    node = mapping.get(current_id) if current_id else None
+    while node:
+        branch_nodes.appendleft(node)
+        parent_id = node.get("parent")
+        node = mapping.get(parent_id) if parent_id else None
+
+    # 2) 遍历分支并输出（out_lines 只缓存“当前这一条消息”的行）
     out_lines: List[str] = []
+    out_append = out_lines.append
     session = ReasoningSession()
 
-    for node_id in branch_ids:
-        node = mapping.get(node_id) or {}
-        msg = node.get("message") or {}
-        author = msg.get("author", {}) or {}
+    for node in branch_nodes:
+        msg = node.get("message") or _EMPTY_DICT
+        author = msg.get("author") or _EMPTY_DICT
         role = author.get("role")
-        content = msg.get("content", {}) or {}
+        content = msg.get("content") or _EMPTY_DICT
         ctype = content.get("content_type")
         create_time = msg.get("create_time")
 
-        # ---- A. 收集 thoughts ----
-        if ctype == "thoughts":
-            session.add_thoughts(create_time, content.get("thoughts", []))
-            continue
-
-        # ---- B. 收集 reasoning_recap（用于 <details><summary>）----
-        if ctype == "reasoning_recap":
-            session.set_recap(content.get("content", ""))
+        # content_type / role 来自 JSON，可能是 list/dict 等不可哈希的值：
+        # 非字符串的 content_type 不会命中任何分支，与逐个 if 比较时一样直接跳过该消息；
+        # 非字符串的 role 只参与“任意角色”的查表
+        if type(ctype) is not str:
             continue
+        if type(role) is not str:
+            role = None
 
-        # ---- C. 收集 assistant code（推理代码）----
-        if role == "assistant" and ctype == "code":
-            code_text = content.get("text", "") or ""
-            lang = (content.get("language") or "").strip().lower()
-
-            # 导出 JSON 里 language 经常是 unknown，但 recipient == "python" 能提示真实语言
-            recip = (msg.get("recipient") or "").strip().lower()
-            if (not lang or lang in ("unknown", "plain", "text")) and recip == "python":
-                lang = "python"
-
-            title = (msg.get("metadata", {}) or {}).get("reasoning_title", "") or ""
-            session.add_code(create_time, title, lang, code_text)
+        # ---- A~D. 推理素材（thoughts / recap / code / tool 输出）：查表分派 ----
+        handler = _HANDLERS.get((None, ctype)) or _HANDLERS.get((role, ctype))
+        if handler is not None:
+            handler(session, msg, content, create_time)
             continue
 
-        # ---- D. 收集 tool 输出（execution_output）并绑定到最近 code ----
+        # 其余 tool 消息（非 python 执行结果）一律不输出
         if role == "tool":
-            tool_name = (author.get("name") or "").lower()
-            if tool_name == "python" and ctype == "execution_output":
-                session.pair_code_output(create_time, content.get("text", "") or "")
             continue
 
         # ---- E. 输出 user/assistant 最终正文（text / multimodal_text）----
-        if role not in {"user", "assistant"}:
+        if role not in _OUTPUT_ROLES:
             continue
         if ctype not in ALLOWED_CONTENT_TYPES:
             continue
@@ -700,7 +984,7 @@ def parse_chat_to_markdown(json_file_path: str) -> str:
         if not rendered_parts:
             continue
 
-        raw_text = "\n".join(rendered_parts).replace("\r\n", "\n").replace("\n\r", "\n").strip()
+        raw_text = _NEWLINE_RE.sub("\n", "\n".join(rendered_parts)).strip()
         if not raw_text:
             continue
 
@@ -708,13 +992,13 @@ def parse_chat_to_markdown(json_file_path: str) -> str:
         # E1) User 消息输出
         # -------------------
         if role == "user":
-            out_lines.append(_render_user_header())
+            out_append(_render_user_header())
 
             # 时间行
             _extend_block(out_lines, _render_user_time_row(format_time(create_time)))
 
             # 时间块后空一行（两个空格）
-            out_lines.append(BLANK)
+            out_append(BLANK)
 
             # 正文（做数学美化）
             user_text = beautify_markdown(raw_text)
@@ -722,6 +1006,8 @@ def parse_chat_to_markdown(json_file_path: str) -> str:
 
             # 结束空三行
             out_lines.extend(TRIPLE_BLANK)
+            yield "\n".join(out_lines)
+            out_lines.clear()
             continue
 
         # -------------------
@@ -738,7 +1024,7 @@ def parse_chat_to_markdown(json_file_path: str) -> str:
         if not session.is_empty():
             details_block = session.build_details_block(default_summary="思考")
 
-        out_lines.append(_render_ai_header())
+        out_append(_render_ai_header())
         _extend_block(out_lines, _render_ai_meta_row(model_slug, time_str))
 
         # 推理块（可选）
@@ -746,25 +1032,39 @@ def parse_chat_to_markdown(json_file_path: str) -> str:
             _extend_block(out_lines, details_block)
 
         # </details> 与正文之间空一行（两个空格）
-        out_lines.append(BLANK)
+        out_append(BLANK)
 
         # 正文
         _extend_block(out_lines, ai_text)
 
         # 结束空三行
         out_lines.extend(TRIPLE_BLANK)
+        yield "\n".join(out_lines)
+        out_lines.clear()
 
     # 3) 兜底：若遍历结束仍有未输出的推理会话，单独输出
     if not session.is_empty():
         details_block = session.build_details_block(default_summary="思考") or ""
-        out_lines.append(_render_ai_header())
+        out_append(_render_ai_header())
         _extend_block(out_lines, _render_ai_meta_row(conversation_default_model, "未知时间"))
+        # 原样输出：thought 正文已在 build_details_block 内美化过，
+        # 不要再对整个 <details> 跑 beautify_markdown（多一遍全量扫描，且可能重复处理）
         _extend_block(out_lines, details_block)
-        out_lines.append(BLANK)
+        out_append(BLANK)
         out_lines.extend(TRIPLE_BLANK)
+        yield "\n".join(out_lines)
 
-    # ✅ 严格按行输出
-    return "\n".join(out_lines)
+    # 转换结束：释放公式美化缓存里持有的消息正文
+    _beautify_math_text.cache_clear()
+
+
+def parse_chat_to_markdown(json_file_path: str) -> str:
+    """
+    一次性返回完整 Markdown 字符串（iter_chat_markdown 的便捷包装）。
+    大文件请直接迭代 iter_chat_markdown 边转换边写出。
+    """
+    # ✅ 严格按行输出：消息块之间只用单个换行连接
+    return "\n".join(iter_chat_markdown(json_file_path))
 
 
 # ==============================================================================
@@ -874,6 +1174,21 @@ def _ensure_output_path(output_path: Optional[str], input_path: str) -> str:
     return output_path or _default_output_path_for(input_path)
 
 
+_WRITE_BUFFER_SIZE = 1 << 20  # 输出文件写缓冲：1 MiB
+
+
+def _remove_partial_output(path: str) -> None:
+    """
+    删除写了一半的输出文件。
+    只删普通文件：符号链接、/dev/stdout 之类的设备文件原样保留，不做任何改动。
+    """
+    try:
+        if os.path.isfile(path) and not os.path.islink(path):
+            os.remove(path)
+    except OSError:
+        pass
+
+
 def run_once(input_path: str, output_path: str) -> int:
     """
     执行一次转换：读 JSON -> 转 Markdown -> 写文件
@@ -883,8 +1198,10 @@ def run_once(input_path: str, output_path: str) -> int:
         print(f"错误：输入文件不存在或不可读：{input_path}")
         return 2
 
+    # 先取出第一块：JSON 读取/解析在这里完成，解析失败时直接返回，不会创建任何文件
+    chunks = iter_chat_markdown(input_path)
     try:
-        markdown_output = parse_chat_to_markdown(input_path)
+        first = next(chunks, None)
     except json.JSONDecodeError as e:
         print(f"错误：JSON 解析失败 - {e}")
         return 3
@@ -892,13 +1209,35 @@ def run_once(input_path: str, output_path: str) -> int:
         print(f"错误：处理失败 - {e}")
         return 4
 
+    # 边转换边写出，避免在内存中拼出整份 Markdown（直接写目标路径：符号链接、设备文件、
+    # 已有文件的权限都与一次性写出时相同）。后续消息处理失败或写入失败时删掉半截文件；
+    # 打开就失败时文件未被改动，不删。
+    opened = False
     try:
         _ensure_parent_dir(output_path)
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(markdown_output)
+        with open(output_path, "w", encoding="utf-8", buffering=_WRITE_BUFFER_SIZE) as f:
+            opened = True
+            if first is not None:
+                f.write(first)
+            while True:
+                try:
+                    chunk = next(chunks, None)
+                except Exception as e:
+                    print(f"错误：处理失败 - {e}")
+                    rc = 4
+                    break
+                if chunk is None:
+                    rc = 0
+                    break
+                f.write("\n")
+                f.write(chunk)
     except Exception as e:
         print(f"错误：无法写入文件 {output_path} - {e}")
-        return 5
+        rc = 5
+    if rc != 0:
+        if opened:
+            _remove_partial_output(output_path)
+        return rc
 
     print(f"已生成 Markdown 文件：{output_path}")
     return 0